@@ -0,0 +1,198 @@
+#!/opt/server-map/bin/python3
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+import yaml
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+# Imports one of the hyphenated scripts next to this one as a module
+def loadScript(name):
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), os.path.join(here, name + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+serverMapModule = loadScript('server-map')
+generator = loadScript('generate-topology')
+
+# Parses command line arguments, from sys.argv unless argv is given
+def parseArgs(argv=None):
+    p = argparse.ArgumentParser(description='Times each step of server-map.py separately on synthetic topologies of growing size, reporting time, peak memory and the empirical complexity of every stage.')
+    p.add_argument('-n','--sizes',nargs='+',type=int,required=False,default=[100,200,400,800],help='numbers of servers to generate a topology with and benchmark')
+    p.add_argument('-r','--repeat',type=int,required=False,default=3,help='times to run each stage, keeping the fastest')
+    p.add_argument('--stages',nargs='+',type=str,required=False,default=list(stages),choices=list(stages),help='stages to benchmark (default all)')
+    p.add_argument('--seed',type=int,required=False,default=0,help='random seed passed on to generate-topology.py')
+    p.add_argument('--json',type=str,required=False,help='also write the results to this JSON file, for use as a later --baseline')
+    p.add_argument('--baseline',type=str,required=False,help='JSON results of an earlier run to compare against; exits with status 1 if any stage got slower by more than --tolerance and --min-seconds')
+    p.add_argument('--tolerance',type=float,required=False,default=0.25,help='fraction by which a stage may be slower than the baseline before it counts as a regression')
+    p.add_argument('--min-seconds',type=float,required=False,default=0.01,help='seconds by which a stage must also be slower than the baseline to count as a regression, so timer noise on millisecond-scale stages is never flagged')
+    return p.parse_args(argv)
+
+# Each stage is set up from the state left by the stages before it, running once as it does so (which also warms up any imports and caches, so no timing includes them), and returns an optional function preparing the input of each run without being timed, the function to time and the state it leaves for the stages after it
+def yamlStage(state):
+    def run():
+        with open(state['environment'], 'rb') as f:
+            return next(yaml.safe_load_all(f))['data']
+    return None, run, {'data' : run()}
+
+def matchStage(state):
+    scheme, data = state['serverMap'].scheme, state['data']
+    def run():
+        scheme.dumpMatches(list(data))
+        return scheme.matchKeys(data, scheme.formatKeys(list(data)))
+    return None, run, {'confs' : run()}
+
+def parseStage(state):
+    serverMap = state['serverMap']
+    serverMap.confs = state['confs']
+    filePaths = list(dict.fromkeys(r[1] for r in serverMap.references()))
+    def run():
+        return serverMapModule.parseServerFiles(filePaths)
+    parsed = run()
+    serverMap.parsed = {path : (serverMapModule.fileSignature(path), data) for path, data in parsed.items()} # so the later stages never reparse
+    return None, run, {'references' : serverMap.references(), 'parsed' : parsed}
+
+def constructStage(state):
+    references, parsed = state['references'], state['parsed']
+    def run():
+        return [(serverMapModule.serverConstructor(server, filePath, buildNum, data=parsed[filePath]), filePath) for server, filePath, buildNum in references]
+    run()
+    return None, run, {'construct' : run}
+
+# Times only the merging half of buildNodes, with freshly constructed servers prepared for each run since merging links them into the nodes
+def mergeStage(state):
+    serverMap = state['serverMap']
+    def prepare():
+        serverMap.nodes = {}
+        serverMap.builtFrom = {}
+        serverMap.graph = None
+        return state['construct']()
+    def run(servers):
+        for server, filePath in servers:
+            serverMap.addServerNode(server, filePath)
+    run(prepare())
+    return prepare, run, {}
+
+def jsonStage(state):
+    path = os.path.join(state['directory'], 'architecture.json')
+    def run():
+        state['serverMap'].exportJSON(path)
+    run()
+    return None, run, {}
+
+def graphStage(state):
+    state['serverMap'].buildGraph()
+    return None, state['serverMap'].buildGraph, {}
+
+def layoutStage(state):
+    G = state['serverMap'].graph
+    def run():
+        return serverMapModule.layoutGraph(G, 'layered')
+    run()
+    return None, run, {}
+
+def renderStage(state):
+    path = os.path.join(state['directory'], 'graph.svg')
+    def run():
+        state['serverMap'].render(path, layout='layered')
+    run()
+    return None, run, {}
+
+stages = {'yaml' : yamlStage, 'match' : matchStage, 'parse' : parseStage, 'construct' : constructStage, 'merge' : mergeStage, 'json' : jsonStage, 'graph' : graphStage, 'layout' : layoutStage, 'render' : renderStage} # in pipeline order
+
+# Returns the fastest of "repeat" timings of run in seconds, and its peak traced memory in bytes from one extra run (tracing slows everything down, so it is kept out of the timings). With prepare, each run is passed a fresh result of it, which is neither timed nor traced
+def measure(run, repeat, prepare=None):
+    best = math.inf
+    for _ in range(repeat):
+        args = (prepare(),) if prepare else ()
+        start = time.perf_counter()
+        run(*args)
+        best = min(best, time.perf_counter() - start)
+    args = (prepare(),) if prepare else ()
+    tracemalloc.start()
+    try:
+        run(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+# Generates a topology of "size" servers and benchmarks every selected stage on it, returning a dict of each stage to its time, peak memory, node count and edge count
+def benchmarkSize(size, args):
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        with contextlib.redirect_stdout(io.StringIO()):
+            generator.main(generator.parseArgs(['-o', directory, '-n', str(size), '--seed', str(args.seed)]))
+        serverMap = serverMapModule.ServerMap(allKeys=True)
+        serverMap.addServers(serverMapModule.expandPaths([directory], ('.conf',)))
+        state = {'directory' : directory, 'environment' : os.path.join(directory, 'config.yaml'), 'serverMap' : serverMap}
+        for name, stage in stages.items(): # every stage is set up so later ones have their inputs, but only the selected ones are timed
+            prepare, run, produced = stage(state)
+            state.update(produced)
+            if name in args.stages:
+                elapsed, peak = measure(run, args.repeat, prepare)
+                results[name] = {'seconds' : elapsed, 'peakBytes' : peak}
+        nodes, edges = len(serverMap.nodes), serverMap.graph.number_of_edges()
+    for result in results.values():
+        result.update({'nodes' : nodes, 'edges' : edges})
+    return results
+
+# Returns the least squares slope of log(seconds) against log(nodes), i.e. k for a stage running in O(n^k), or None with fewer than two distinct sizes
+def complexity(points):
+    points = [(math.log(n), math.log(max(s, 1e-9))) for n, s in points]
+    if len({x for x, _ in points}) < 2:
+        return None
+    meanX = sum(x for x, _ in points) / len(points)
+    meanY = sum(y for _, y in points) / len(points)
+    return sum((x - meanX) * (y - meanY) for x, y in points) / sum((x - meanX) ** 2 for x, _ in points)
+
+# Returns a message for every stage and size that got slower than the baseline by more than both tolerance and minSeconds
+def regressions(results, baseline, tolerance, minSeconds):
+    found = []
+    for size, sizeResults in results['sizes'].items():
+        for name, result in sizeResults.items():
+            old = baseline['sizes'].get(size, {}).get(name)
+            if old and result['seconds'] > old['seconds'] * (1 + tolerance) and result['seconds'] - old['seconds'] > minSeconds:
+                found.append(name + ' at ' + size + ' servers: ' + format(old['seconds'], '.4f') + 's -> ' + format(result['seconds'], '.4f') + 's')
+    return found
+
+# Benchmarks every size, prints a table of time and peak memory per stage with its fitted exponent, and compares against the baseline if given
+def main(args=None):
+    if args is None:
+        args = parseArgs()
+    warnings.simplefilter('ignore') # the pygraphviz fallback warning would repeat for every size
+    results = {'sizes' : {}, 'complexity' : {}}
+    for size in args.sizes:
+        results['sizes'][str(size)] = benchmarkSize(size, args)
+    for name in args.stages:
+        results['complexity'][name] = complexity([(r[name]['nodes'], r[name]['seconds']) for r in results['sizes'].values()])
+
+    print('stage      ' + ''.join(format(str(size) + ' servers', '>24') for size in args.sizes) + '   O(n^k)')
+    for name in args.stages:
+        cells = ''.join(format(format(r[name]['seconds'] * 1000, '.1f') + 'ms ' + format(r[name]['peakBytes'] / 2**20, '.1f') + 'MB', '>24') for r in results['sizes'].values())
+        k = results['complexity'][name]
+        print(format(name, '<11') + cells + '   ' + ('-' if k is None else format(k, '.2f')))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance, args.min_seconds)
+        for message in found:
+            print('Regression: ' + message, file=sys.stderr)
+        return 1 if found else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
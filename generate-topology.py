@@ -0,0 +1,102 @@
+#!/opt/server-map/bin/python3
+
+import argparse
+import json
+import os
+import random
+
+# Parses command line arguments, from sys.argv unless argv is given
+def parseArgs(argv=None):
+    p = argparse.ArgumentParser(description='Generates a synthetic environment config and server configs in the shape of the examples in configs/, for load testing server-map.py.')
+    p.add_argument('-o','--output',type=str,required=False,default='synthetic',help='directory to write the environment config and server configs to')
+    p.add_argument('-n','--servers',type=int,required=False,default=100,help='number of server configs to generate')
+    p.add_argument('--api-fraction',type=float,required=False,default=0.3,help='fraction of the servers that are API servers, the rest being stream servers')
+    p.add_argument('--topics',type=int,required=False,default=None,help='number of distinct Kafka topics (defaults to half the number of servers)')
+    p.add_argument('--collections',type=int,required=False,default=None,help='number of distinct MongoDB collections (defaults to a fifth of the number of servers)')
+    p.add_argument('--fan-out',type=int,required=False,default=2,help='Kafka topics each API server produces to')
+    p.add_argument('--fan-in',type=int,required=False,default=2,help='Kafka topics each stream server consumes, at most 4 (packed, unpacked, agents_unpacked, updates)')
+    p.add_argument('--skew',type=float,required=False,default=1.0,help='Zipf exponent of topic popularity; higher values concentrate producers and consumers on a few hub topics like event-store')
+    p.add_argument('--hidden',type=int,required=False,default=0,help='environment entries referencing server configs that are not generated, like IRRELEVANT_CONF in the example')
+    p.add_argument('--alt-prefix',type=float,required=False,default=0.2,help='fraction of topics named with the "alt-prefix-" prefix')
+    p.add_argument('--svc-fraction',type=float,required=False,default=0.1,help='fraction of stream servers named with the _SVC_PKG/_UNPACKER_CONF variant of the naming scheme')
+    p.add_argument('--builds',type=int,required=False,default=3,help='number of distinct build numbers to spread across the servers')
+    p.add_argument('--seed',type=int,required=False,default=0,help='random seed, so the same arguments always generate the same corpus')
+    return p.parse_args(argv)
+
+# Writes the environment config and server configs, then prints the server-map.py command that maps them
+def main(args=None):
+    if args is None:
+        args = parseArgs()
+    random.seed(args.seed)
+    topicCount = args.topics or max(1, args.servers // 2)
+    collectionCount = args.collections or max(1, args.servers // 5)
+    topics = [('alt-prefix-' if random.random() < args.alt_prefix else '') + 'topic-' + str(i) for i in range(topicCount)]
+    weights = [1 / (i + 1) ** args.skew for i in range(topicCount)] # topic-0 is the biggest hub
+    collections = ['"prefix.' + str(i) + '"' if i % 2 else 'collection' + str(i) for i in range(collectionCount)] # half quoted with the prefix the mapper strips
+    os.makedirs(args.output, exist_ok=True)
+
+    data = {}
+    apiCount = round(args.servers * args.api_fraction)
+    for i in range(args.servers):
+        build = random.randint(1, args.builds)
+        if i < apiCount:
+            name, kind, text = 'API' + str(i), 'api', apiConfig(random.sample(topics, min(args.fan_out, topicCount)), random.sample(collections, min(2, collectionCount)))
+            data.update({name + '_PKG' : 'api-code-v' + str(build) + '.zip', name + '_CONF' : 'dir/' + kind + '-' + str(i) + '.conf'})
+        else:
+            name, kind, text = 'STREAM' + str(i), 'stream', streamConfig(weightedSample(topics, weights, min(args.fan_in, 4, topicCount)))
+            if random.random() < args.svc_fraction:
+                data.update({name + '_SVC_PKG' : 'stream-code-v' + str(build) + '.zip', name + '_UNPACKER_CONF' : 'dir/' + kind + '-' + str(i) + '.conf'})
+            else:
+                data.update({name + '_PKG' : 'stream-code-v' + str(build) + '.zip', name + '_CONF' : 'dir/' + kind + '-' + str(i) + '.conf'})
+        with open(os.path.join(args.output, kind + '-' + str(i) + '.conf'), 'w') as f:
+            f.write(text)
+    for i in range(args.hidden):
+        data.update({'HIDDEN' + str(i) + '_PKG' : 'whatever-code-v1.zip', 'HIDDEN' + str(i) + '_CONF' : 'dir/hidden-' + str(i) + '.conf'})
+
+    with open(os.path.join(args.output, 'config.yaml'), 'w') as f: # written by hand in the example's layout; JSON strings are valid YAML scalars
+        f.write('apiVersion: v1\nkind: ConfigMap\nmetadata:\n  name: synthetic-configmap\ndata:\n')
+        for key, value in data.items():
+            f.write('    ' + key + ': ' + json.dumps(value) + '\n')
+    print('Generated ' + str(args.servers) + ' server configs in ' + args.output + ', map them with:\npython server-map.py --all-keys -e ' + os.path.join(args.output, 'config.yaml') + ' -s ' + args.output)
+
+# Picks k distinct items, each with probability proportional to its weight
+def weightedSample(items, weights, k):
+    picked = {}
+    while len(picked) < k:
+        item = random.choices(items, weights)[0]
+        picked.setdefault(item, None)
+    return list(picked)
+
+# Returns an API server config in the shape of configs/example-api.conf, producing to "topics" and persisting to "collections"
+def apiConfig(topics, collections):
+    streams = ''.join('''  {
+    type = "kafka"
+    create {
+      log.topic = "''' + topic + '''"
+    }
+    recTypes = ["*"]
+    resources = ["objs"]
+    events = ["*"]
+  },
+''' for topic in topics)
+    return '''logstreams = [
+''' + streams + ''']
+
+persistence {
+  object = ["kafka","mongo"]
+  dedicated_partitions = [
+    "partition_0",
+    "partition_1"
+  ]
+  collection {
+''' + ''.join('    ' + collection + ' = "' + collection.strip('"') + '"\n' for collection in collections) + '''  }
+}
+'''
+
+# Returns a stream server config in the shape of configs/example-stream.conf, consuming "topics" in order of its groups
+def streamConfig(topics):
+    groups = ['packed', 'unpacked', 'agents_unpacked', 'updates']
+    return 'apiEndpoint = "example.org"\n\n' + ''.join(group + ' {\n  topic = "' + topic + '"\n}\n\n' for group, topic in zip(groups, topics))
+
+if __name__ == "__main__":
+    main()
@@ -1,60 +1,407 @@
 #!/opt/server-map/bin/python3
 
 import argparse
+import array
+import concurrent.futures
+import contextlib
+import cProfile
 import datetime
 from datetime import timedelta
 from dateutil import relativedelta
 import functools
+import hashlib
+import html
+import itertools
 import json
-import matplotlib.pyplot as plt
-import networkx as nx
+import math
+import mmap
 import os
-import pyhocon
+import pickle
 import re
+import struct
+import sys
+import time
 import warnings
 import yaml
 
-p = argparse.ArgumentParser(description='Takes an environment config file and server config files and outputs the relevant data stream information.')
-p.add_argument('-e','--environment',type=str,required=True,help='location of config YAML file')
-p.add_argument('-s','--servers',nargs='+',type=str,required=True,help='space-separated list of server config HOCON files')
-p.add_argument('-o','--output',nargs=2,type=str,required=False,default='pod_architecture.json graph.png'.split(),help='path to output architecture JSON and map PNG')
-args = p.parse_args()
+# Parses command line arguments, from sys.argv unless argv is given. Kept out of import time so the module can be loaded as a library
+def parseArgs(argv=None):
+    p = argparse.ArgumentParser(description='Takes an environment config file and server config files and outputs the relevant data stream information.')
+    p.add_argument('-e','--environment',nargs='+',type=str,required=False,help='location of config YAML file(s), or directories of them; with more than one, each output is prefixed with its environment name')
+    p.add_argument('-s','--servers',nargs='+',type=str,required=False,help='space-separated list of server config HOCON files, or directories of .conf files')
+    p.add_argument('-o','--output',nargs=2,type=str,required=False,default='pod_architecture.json graph.png'.split(),help='path to output architecture JSON and map PNG (or .svg, .html or .dot to skip matplotlib)')
+    p.add_argument('--all-keys',action='store_true',help='map every environment config key matching the naming scheme instead of only API_PKG, STREAM_PKG and ALT_STREAM_PKG')
+    p.add_argument('--cache-dir',type=str,required=False,help='directory in which to cache parsed server configs between runs')
+    p.add_argument('-j','--jobs',type=int,required=False,default=1,help='number of processes to parse server configs with')
+    p.add_argument('--cache-size',type=int,required=False,default=256,help='maximum size of the parse cache in MB before least recently used entries are evicted')
+    p.add_argument('--save-snapshot',type=str,required=False,help='also write the architecture to a binary snapshot; with more than one environment, it is prefixed with the environment name')
+    p.add_argument('--load-snapshot',type=str,required=False,help='build outputs from a binary snapshot instead of environment and server configs')
+    p.add_argument('--diff',nargs=2,type=str,required=False,metavar=('OLD','NEW'),help='print the differences between two snapshots or architecture JSON files and exit with status 1 if there are any')
+    p.add_argument('--layout',type=str,required=False,default='dot',choices=layoutMethods,help='how to lay out the map: graphviz dot (default) or sfdp, the built-in layered layout which needs no graphviz, or a spring layout')
+    p.add_argument('--layout-cache',type=str,required=False,help='JSON file of node positions to reuse between runs, so only new nodes are placed and the map stays stable; with more than one environment, it is prefixed with the environment name')
+    p.add_argument('--collapse-topics',nargs='+',type=str,required=False,default=[],metavar='PREFIX',help='draw all Kafka topics starting with each prefix as a single node')
+    p.add_argument('--hide-leaf-collections',action='store_true',help='leave MongoDB collections used by only one server off the map')
+    p.add_argument('--cluster-builds',action='store_true',help='draw all servers sharing a build number as a single node')
+    p.add_argument('--watch',action='store_true',help='keep running, rebuilding and rewriting the outputs whenever the environment config or one of its server configs changes')
+    p.add_argument('--profile',type=str,nargs='?',required=False,const='server-map-profile',metavar='PREFIX',help='profile the run, writing a cProfile dump to PREFIX.prof and a JSON report of the time taken by each stage, server config parse and server construction to PREFIX.json (default prefix server-map-profile)')
+    p.add_argument('--stats',action='store_true',help='print node, edge and degree statistics of each architecture to stdout as JSON, one line per environment; the scheme match dump then goes to stderr so stdout stays parseable')
+    p.add_argument('--echo',action='store_true',help='also print the architecture JSON to stdout, moving the scheme match dump to stderr')
+    p.add_argument('--compact',action='store_true',help='write the architecture JSON without indentation')
+    p.add_argument('--no-graph',action='store_true',help='only write the architecture JSON, skipping the map and its plotting imports')
+    args = p.parse_args(argv)
+    if not (args.load_snapshot or args.diff) and not (args.environment and args.servers):
+        p.error('the following arguments are required: -e/--environment, -s/--servers (unless --load-snapshot or --diff is given)')
+    if args.watch and (args.load_snapshot or args.diff or len(args.environment) != 1):
+        p.error('--watch needs exactly one environment config')
+    return args
 
-def main():
-    environment_keys = ['API_PKG', 'STREAM_PKG', 'ALT_STREAM_PKG'] # keys of items in the environment config to extract
-    scheme = NamingScheme(formats=['_PKG','_SVC_PKG'], mutations=['_CONF','_UNPACKER_CONF']) # current naming scheme within the environment config files
+# Runs the command line, under cProfile and with timings collected if --profile is given
+def main(args=None):
+    if args is None:
+        args = parseArgs()
+    if not args.profile:
+        return run(args)
+    timings.enabled = True
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(run, args)
+    finally:
+        profile.dump_stats(args.profile + '.prof')
+        with open(args.profile + '.json', 'w') as f:
+            json.dump(timings.report(), f, indent=2)
+
+def run(args):
+    if args.diff:
+        diff = diffArchitectures(readArchitecture(args.diff[0]), readArchitecture(args.diff[1]))
+        print(json.dumps(diff, indent=2))
+        return 1 if any(diff.values()) else 0
+    cache = ParseCache(args.cache_dir, args.cache_size*1024*1024) if args.cache_dir else None
+    serverMap = ServerMap(cache=cache, jobs=args.jobs)
+    serverMap.keepSources = False
+    serverMap.allKeys = args.all_keys
+    if args.stats or args.echo: # keeps stdout to JSON alone
+        serverMap.log = sys.stderr
+    serverMap.collapsePrefixes = args.collapse_topics
+    serverMap.hideLeafCollections = args.hide_leaf_collections
+    serverMap.clusterBuilds = args.cluster_builds
+    if args.load_snapshot:
+        serverMap.loadSnapshot(args.load_snapshot)
+        writeOutputs(serverMap, args, args.output, layoutCache=args.layout_cache)
+        return
+    serverMap.addServers(expandPaths(args.servers, ('.conf',)))
+    environments = expandPaths(args.environment, ('.yaml', '.yml'))
+    for environment in serverMap.buildEnvironments(environments):
+        if len(environments) == 1:
+            writeOutputs(serverMap, args, args.output, args.save_snapshot, args.layout_cache)
+        else:
+            writeOutputs(serverMap, args, [environmentOutput(path, environment) for path in args.output], args.save_snapshot and environmentOutput(args.save_snapshot, environment), args.layout_cache and environmentOutput(args.layout_cache, environment))
+    if cache:
+        cache.evict()
+    if args.watch:
+        serverMap.watch(lambda changed: writeOutputs(serverMap, args, args.output, args.save_snapshot, args.layout_cache))
+
+# Writes the architecture JSON, map and (if requested) snapshot of the environment currently held by serverMap, laying the map out through layoutCache if one is given
+def writeOutputs(serverMap, args, output, snapshot=None, layoutCache=None):
+    if args.stats:
+        print(json.dumps({'environment' : serverMap.environment, **serverMap.store().stats()}))
+    if snapshot:
+        serverMap.saveSnapshot(snapshot)
+    serverMap.exportJSON(output[0], indent=None if args.compact else 2, echo=args.echo)
+    if not args.no_graph:
+        serverMap.render(output[1], layout=args.layout, layoutCache=layoutCache)
+
+# Replaces any directories in paths with the files inside them ending in one of extensions, e.g. the environment config YAML files
+def expandPaths(paths, extensions):
+    expanded = []
+    for path in paths:
+        if os.path.isdir(path):
+            expanded += sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith(extensions))
+        else:
+            expanded.append(path)
+    return expanded
+
+# Prefixes an output path with the name of the environment it was built from, e.g. graph.png -> dev-config-graph.png
+def environmentOutput(path, environment):
+    head, tail = os.path.split(path)
+    return os.path.join(head, os.path.splitext(os.path.split(environment)[-1])[0] + '-' + tail)
+
+# Builds the data stream map of an environment in the same four steps as the command line, keeping the server config index and every parsed server config in memory so that maps for many environments can be built in one process
+class ServerMap:
+    environmentKeys = ['API_PKG', 'STREAM_PKG', 'ALT_STREAM_PKG'] # keys of items in the environment config to extract
+
+    def __init__(self, scheme=None, environmentKeys=None, cache=None, jobs=1, allKeys=False):
+        self.scheme = scheme or NamingScheme(formats=['_PKG','_SVC_PKG'], mutations=['_CONF','_UNPACKER_CONF']) # current naming scheme within the environment config files
+        if environmentKeys is not None:
+            self.environmentKeys = environmentKeys
+        self.allKeys = allKeys # whether to extract every key matching the naming scheme instead of only environmentKeys
+        self.log = None # file the scheme match dump of each environment is printed to, stdout if None
+        self.cache = cache
+        self.jobs = jobs
+        self.keepSources = True # whether server nodes keep their parsed source config, and parsed configs stay in memory after buildEnvironments; without it they are reparsed on demand
+        self.servers = {} # server config filename -> path
+        self.parsed = {} # server config path -> (file signature, parsed config)
+        self.environment = None
+        self.confs = []
+        self.nodes = {}
+        self.builtFrom = {} # server config path -> nicknames of the server nodes built from it
+        self.graph = None # networkx graph of the current nodes, once built
+        self.graphStore = None # array-backed copy of the current nodes, once built
+        self.collapsePrefixes = [] # level of detail for buildGraph: KafkaTopic name prefixes to collapse into one node each,
+        self.hideLeafCollections = False # whether to hide MongoCollections with at most one neighbor,
+        self.clusterBuilds = False # and whether to collapse servers sharing a build number into one node
+
+    # Adds server config files to the filename index, returning any filenames given more than once
+    def addServers(self, paths):
+        index, collisions = indexServers(list(self.servers.values()) + list(paths))
+        self.servers = index
+        return collisions
 
     # Step 1: Reads data out of environment config YAML, prints everything in 'data' to the command line, and stores every match of the environment keys with the naming scheme to the list "confs"
-    with open(args.environment, 'rb') as f:
-        data = next(yaml.safe_load_all(f))['data']
-        print('Complete scheme.formats match dump for ' + args.environment + ': [' + ', '.join(scheme.dumpMatches(list(data))) + ']')
-        confs = scheme.matchKeys(data, environment_keys)
+    def loadEnvironment(self, path):
+        with timings.stage('load environment', path), open(path, 'rb') as f:
+            data = next(yaml.safe_load_all(f))['data']
+            print('Complete scheme.formats match dump for ' + path + ': [' + ', '.join(self.scheme.dumpMatches(list(data))) + ']', file=self.log or sys.stdout)
+            self.confs = self.scheme.matchKeys(data, self.scheme.formatKeys(list(data)) if self.allKeys else self.environmentKeys)
+        self.environment = path
+        self.nodes = {}
+        self.builtFrom = {}
+        self.graph = None
+        self.graphStore = None
+        return self.confs
+
+    # Returns a (server key, file path, build number) tuple for every server config the environment references, in environment order, so nodes are built deterministically however the files were parsed
+    def references(self):
+        references = []
+        for config in self.confs:
+            buildNum = re.search(r'v(\d+)\D*$', config[list(config)[0]])
+            buildNum = buildNum.group(1) if buildNum else -1
+            for server in list(config)[1:]:
+                filePath = self.servers.get(os.path.split(config[server])[-1]) # Requires identical filenames to those in dev-config
+                if filePath is None:
+                    warnings.warn('No server config given for ' + server + ' ("' + config[server] + '")')
+                    continue
+                references.append((server, filePath, buildNum))
+        return references
+
+    # Loads every environment in paths and parses the union of their server configs up front, so a config shared by several environments is parsed once (and in one pool), then builds the nodes of each environment in turn, yielding its path once they're ready
+    def buildEnvironments(self, paths):
+        confs = {}
+        filePaths = {}
+        for path in paths:
+            confs[path] = self.loadEnvironment(path)
+            filePaths.update(dict.fromkeys(r[1] for r in self.references()))
+        self.parse(list(filePaths))
+        for i, path in enumerate(paths):
+            self.environment = path
+            self.confs = confs[path]
+            self.buildNodes()
+            if i == len(paths) - 1 and not self.keepSources:
+                self.parsed.clear() # nothing else will be built from them, so free them before outputs are written
+            yield path
+
+    # Parses every file in filePaths that isn't already held in memory unchanged, and returns a dict of each path to its parsed config
+    def parse(self, filePaths):
+        signatures = {path : fileSignature(path) for path in filePaths}
+        stale = [path for path in filePaths if path not in self.parsed or self.parsed[path][0] != signatures[path]]
+        with timings.stage('parse', self.environment) if stale else contextlib.nullcontext(): # later calls find everything parsed already, so only real parses are timed
+            for path, data in parseServerFiles(stale, self.cache, self.jobs).items():
+                self.parsed[path] = (signatures[path], data)
+        return {path : self.parsed[path][1] for path in filePaths}
 
     # Step 2: Iterates through every config referenced in the environment keys and adds each unique TreeElement (alongside its inputs and outputs) to a dict of "nodes", merging repeats along the way
-    nodes = {}
-    for config in confs:
-        buildNum = re.search(r'v\d+$', config[list(config)[0]]).group(1)
-        for server in list(config)[1:]:
-            for filePath in args.servers:
-                if os.path.split(config[server])[-1] in filePath: # Requires identical filenames to those in dev-config
-                    currentServer = serverConstructor(server, filePath, buildNum)
-            if isinstance(currentServer, TreeElement): # Ensures every node has a valid constructor
-                nodes.update({currentServer.nickname : currentServer})
-                for n in (currentServer.getInputs() + currentServer.getOutputs()):
-                    if n.nickname in nodes:
-                        n = nodes[n.nickname].merge(n)
+    def buildNodes(self):
+        references = self.references()
+        parsed = self.parse(list(dict.fromkeys(r[1] for r in references)))
+        self.nodes = {}
+        self.builtFrom = {}
+        self.graph = None
+        self.graphStore = None
+        with timings.stage('build nodes', self.environment):
+            for server, filePath, buildNum in references:
+                self.addServerNode(serverConstructor(server, filePath, buildNum, self.cache, data=parsed[filePath]), filePath)
+        return self.nodes
+
+    # Adds a newly constructed server and its inputs and outputs to the nodes dict, merging each into any equal node already there and recording filePath as the provenance of every edge it brings. Returns the nicknames of every node touched
+    def addServerNode(self, currentServer, filePath):
+        if not isinstance(currentServer, TreeElement): # Ensures every node has a valid constructor
+            return set()
+        neighbors = []
+        for n in (list(currentServer.inputs.values()) + list(currentServer.outputs.values())):
+            if n.nickname in self.nodes:
+                n = self.nodes[n.nickname].merge(n)
+                currentServer.relink(n)
+            else:
+                self.nodes.update({n.nickname : n})
+            neighbors.append(n)
+        server = self.nodes.setdefault(currentServer.nickname, currentServer)
+        if server is not currentServer: # the same server built from another config, so both configs' edges are kept
+            server.merge(currentServer)
+            for n in neighbors:
+                n.relink(server)
+        for n in neighbors:
+            server.contribute(n, filePath)
+            n.contribute(server, filePath)
+        if not self.keepSources:
+            currentServer.releaseSource()
+        self.builtFrom.setdefault(filePath, []).append(server.nickname)
+        return {server.nickname} | {n.nickname for n in neighbors}
+
+    # Retracts every edge contributed by the server config at filePath in time proportional to the servers' degree, dropping any node left without edges. Returns the nicknames of every node touched
+    def removeServer(self, filePath):
+        affected = set()
+        for nickname in self.builtFrom.pop(filePath, []):
+            server = self.nodes.get(nickname)
+            if server is None:
+                continue
+            affected.add(nickname)
+            for n in list(server.inputs.values()) + list(server.outputs.values()):
+                n = self.nodes.get(n.nickname, n)
+                server.retract(n, filePath)
+                n.retract(server, filePath)
+                affected.add(n.nickname)
+                if not n.inputs and not n.outputs:
+                    self.nodes.pop(n.nickname, None)
+            if not server.inputs and not server.outputs:
+                self.nodes.pop(nickname, None)
+        return affected
+
+    # Re-parses a single server config and swaps the server nodes built from it for freshly built ones, patching the graph in place if it has been built. Returns the nicknames of every node touched
+    def replaceServer(self, filePath):
+        data = self.parse([filePath])[filePath]
+        affected = self.removeServer(filePath)
+        for server, path, buildNum in self.references():
+            if path == filePath:
+                affected |= self.addServerNode(serverConstructor(server, path, buildNum, self.cache, data=data), path)
+        if self.graph is not None:
+            if self.collapsePrefixes or self.hideLeafCollections or self.clusterBuilds:
+                self.graph = None # collapsed nodes span unaffected ones, so the graph is rebuilt on next use instead
+            else:
+                self.patchGraph(affected)
+        return affected
+
+    # Polls the environment config and the server configs it references every "interval" seconds until interrupted. A changed server config only has its own nodes rebuilt, while a changed environment config rebuilds everything; onChange is called with the changed paths after each update
+    def watch(self, onChange, interval=0.5):
+        watched = {path : fileSignature(path) for path in [self.environment] + list(self.builtFrom)}
+        try:
+            while True:
+                time.sleep(interval)
+                changed = [path for path, signature in watched.items() if fileSignature(path) != signature]
+                if not changed:
+                    continue
+                try:
+                    if self.environment in changed:
+                        self.loadEnvironment(self.environment)
+                        self.buildNodes()
                     else:
-                        nodes.update({n.nickname : n})
+                        for path in changed:
+                            self.replaceServer(path)
+                    onChange(changed)
+                except Exception as e: # configs are often briefly invalid mid-edit, so keep watching
+                    warnings.warn('Could not rebuild after changes to [' + ', '.join(changed) + ']: ' + repr(e))
+                watched = {path : fileSignature(path) for path in [self.environment] + list(self.builtFrom)}
+        except KeyboardInterrupt:
+            pass
+
+    # Step 3: Encodes architecture as JSON and streams it to file one node at a time, so the whole document is never held in memory. "echo" also copies it to stdout, and an indent of None writes it compactly
+    def exportJSON(self, path, indent=2, echo=False):
+        encoder = CustomJSONEncoder(sort_keys=True, indent=indent, separators=None if indent is not None else (',', ':'))
+        newline = '\n' + ' '*indent if indent is not None else ''
+        with timings.stage('export JSON', self.environment), open(path, 'w') as f:
+            def write(chunk):
+                f.write(chunk)
+                if echo:
+                    sys.stdout.write(chunk)
+            write('{')
+            for i, nickname in enumerate(sorted(self.nodes)):
+                node = self.nodes[nickname]
+                node = encoder.encode(node.serialize() if isinstance(node, TreeElement) else node).replace('\n', newline) # JSON strings never contain raw newlines, so this only indents nesting
+                write((',' if i else '') + newline + json.dumps(nickname) + encoder.key_separator + node)
+            write(('\n' if indent is not None and self.nodes else '') + '}')
+        if echo:
+            sys.stdout.write('\n')
+
+    # Returns a GraphStore of the current nodes, rebuilt only when the graph has changed since the last call
+    def store(self):
+        if self.graphStore is None or self.graphStore.nodes is not self.nodes or self.graphStore.generation != TreeElement.generation:
+            self.graphStore = GraphStore(self.nodes)
+        return self.graphStore
 
-    # Step 3: Encodes architecture as JSON and writes to file
-    with open(args.output[0], 'w') as f:
-        dump = json.dumps(nodes, sort_keys=True, cls=CustomJSONEncoder, indent=2)
-        print(dump)
-        f.write(dump)
+    # Writes the current nodes to a binary snapshot at path
+    def saveSnapshot(self, path):
+        with timings.stage('save snapshot', self.environment):
+            return writeSnapshot(self.nodes, path, self.store())
 
-    # Step 4: Iterates through the nodes dict to find each unique edge, adds it to a graph, and draws it to a networkx plot
-    G = nx.DiGraph()
-    for node in nodes.values(): # graphs each edge once based on the union of every node's inputs
+    # Replaces the current nodes with those of a binary snapshot, skipping steps 1 and 2 entirely
+    def loadSnapshot(self, path):
+        self.environment = path
+        self.confs = []
+        with timings.stage('load snapshot', path):
+            self.nodes = readSnapshot(path)
+        self.builtFrom = {}
+        self.graph = None
+        self.graphStore = None
+        return self.nodes
+
+    # Step 4a: Iterates through the nodes dict to find each unique edge and adds it to a networkx graph, at the configured level of detail
+    def buildGraph(self):
+        import networkx as nx # deferred along with matplotlib so JSON-only runs never pay for the plotting stack
+        G = nx.DiGraph()
+        aggregates, restore = self.applyDetail()
+        try:
+            with timings.stage('build graph', self.environment):
+                for node in list(self.nodes.values()) + aggregates: # graphs each edge once based on the union of every node's inputs
+                    self.graphInputs(G, node)
+        finally:
+            restore()
+        self.graph = G
+        return G
+
+    # Hides nodes for the configured level of detail through their isVisible flags. Collapsed nodes are also pointed at an aggregate node that stands in for all of them, and streams reading a collapsed topic record its group against the aggregate too so their edges keep their colors. Returns the aggregates and a function which makes everything visible again
+    def applyDetail(self):
+        aggregates = {}
+        hidden = []
+        grouped = [] # (stream, aggregate nickname) of each inputGroups entry added for an aggregate
+        def hide(node, label=None):
+            if label is not None:
+                aggregate = aggregates.get(label)
+                if aggregate is None:
+                    aggregate = aggregates[label] = TreeElement(label, {})
+                for i in node.inputs.values(): # only read by getInputs, so the members' neighbors are left untouched
+                    aggregate.addInput(i)
+                for o in node.outputs.values():
+                    aggregate.addOutput(o)
+                    if isinstance(o, StreamElement) and node.nickname in o.inputGroups and aggregate.nickname not in o.inputGroups: # so colorHandler finds the group of the edge from the aggregate
+                        o.inputGroups[aggregate.nickname] = o.inputGroups[node.nickname]
+                        grouped.append((o, aggregate.nickname))
+                node.collapsedInto = aggregate
+            node.isVisible = False
+            hidden.append(node)
+        for node in list(self.nodes.values()):
+            if not node.isVisible:
+                continue
+            if isinstance(node, KafkaTopic):
+                for prefix in self.collapsePrefixes:
+                    if node.name.startswith(prefix) or node.nickname.startswith(prefix):
+                        hide(node, prefix + '*')
+                        break
+            elif isinstance(node, MongoCollection):
+                if self.hideLeafCollections and len(node.inputs) + len(node.outputs) <= 1: # collections are only ever read by API servers, so a leaf has at most one of them
+                    hide(node)
+            elif isinstance(node, (ApiElement, StreamElement)):
+                if self.clusterBuilds:
+                    hide(node, 'build ' + str(node.buildNum))
+        def restore():
+            for node in hidden:
+                node.collapsedInto = None
+                node.isVisible = True
+            for stream, nickname in grouped:
+                stream.inputGroups.pop(nickname, None)
+        return list(aggregates.values()), restore
+
+    # Adds an edge to G from each of node's visible inputs
+    def graphInputs(self, G, node):
+        if not node.isVisible: # reached through its visible neighbors' getInputs instead
+            return
         if hasattr(node, 'colorHandler'): # colored edge handler
             for i in node.getInputs():
                 color = node.colorHandler(i)
@@ -62,24 +409,421 @@ def main():
         else: # defaults to black edges
             for i in node.getInputs():
                 G.add_edge(i.nickname, node.nickname, edge_color='black')
-    ec = [G[u][v]['edge_color'] for u,v in G.edges()]
-    plt.figure(figsize=(15,15))
-    G = nx.relabel_nodes(G, {'': '[empty]'}) # graphviz can't handle empty strings
-    nx.draw(G, pos=nx.drawing.nx_agraph.graphviz_layout(G, prog='dot', args="-Grankdir=LR"), edge_color=ec, with_labels=True, width=3, bbox=dict(facecolor='firebrick', boxstyle='round,pad=0.2'))
-    #plt.show()
-    plt.savefig(args.output[1])
-
-# Handles identification of server type based on the contents of the config file and returns the corresponding treeElement
-def serverConstructor(name, filename, buildNum):
-    name = re.sub(r'_CONF', '', name)
-    with open(filename, 'r') as f:
-        data = pyhocon.ConfigFactory.parse_string(f.read())
-        if 'logstreams' in data:
-            return ApiElement(name, data, buildNum)
-        elif 'packed' in data:
-            return StreamElement(name, data, buildNum)
+
+    # Regraphs the incoming edges of the "affected" nicknames in place, dropping any that no longer exist or are left without edges
+    def patchGraph(self, affected):
+        G = self.graph
+        for nickname in affected:
+            if nickname in G:
+                G.remove_edges_from(list(G.in_edges(nickname)))
+        for nickname in affected:
+            if nickname in self.nodes:
+                self.graphInputs(G, self.nodes[nickname])
+        G.remove_nodes_from([nickname for nickname in affected if nickname in G and (nickname not in self.nodes or G.degree(nickname) == 0)])
+
+    # Step 4b: Lays out the graph with one of layoutMethods (reusing the positions stored in layoutCache, if given) and saves it to path. Paths ending in .svg, .html or .dot/.gv are written directly from the graph; anything else is drawn to a networkx plot
+    def render(self, path, G=None, layout='dot', layoutCache=None):
+        import networkx as nx
+        if G is None:
+            G = self.graph if self.graph is not None else self.buildGraph()
+        G = nx.relabel_nodes(G, {'': '[empty]'}) # graphviz can't handle empty strings
+        extension = os.path.splitext(path)[1].lower()
+        if extension in ('.dot', '.gv'): # graphviz lays these out itself
+            with timings.stage('draw', self.environment):
+                return writeDot(G, path)
+        with timings.stage('layout', self.environment):
+            pos = cachedLayout(G, layout, layoutCache) if layoutCache else layoutGraph(G, layout)
+        size = canvasSize(pos)
+        with timings.stage('draw', self.environment):
+            if extension == '.svg':
+                return writeSvg(G, pos, path, size)
+            if extension in ('.html', '.htm'):
+                return writeHtml(G, pos, path, size)
+            import matplotlib.pyplot as plt
+            ec = [G[u][v]['edge_color'] for u,v in G.edges()]
+            plt.figure(figsize=size)
+            nx.draw(G, pos=pos, edge_color=ec, with_labels=True, width=3, bbox=dict(facecolor='firebrick', boxstyle='round,pad=0.2'))
+            #plt.show()
+            plt.savefig(path)
+            plt.close()
+
+# Returns a (width, height) canvas size in inches fitted to the laid out graph: one column per rank and one row per node in the fullest rank for ranked layouts, or a square grid otherwise. Clamped so tiny maps stay legible and huge ones stay within what matplotlib can rasterize at 100 dpi
+def canvasSize(pos, minimum=4, maximum=600):
+    if not pos:
+        return (minimum, minimum)
+    columns = {}
+    for node, (x, y) in pos.items():
+        columns[round(x, 3)] = columns.get(round(x, 3), 0) + 1
+    longest = max(len(str(node)) for node in pos)
+    if len(columns) > 2 * math.sqrt(len(pos)): # not ranked, e.g. spring or sfdp
+        width = height = math.ceil(math.sqrt(len(pos)))
+    else:
+        width, height = len(columns), max(columns.values())
+    clamp = lambda inches: min(max(inches, minimum), maximum)
+    return (clamp(width * (1 + 0.1 * longest)), clamp(height * 0.45))
+
+# Writes G as a Graphviz DOT file with the same left to right ranks and edge colors as the rendered map
+def writeDot(G, path):
+    def quote(name):
+        return '"' + str(name).replace('\\', '\\\\').replace('"', '\\"') + '"'
+    with open(path, 'w') as f:
+        f.write('digraph "server-map" {\n  rankdir=LR;\n  node [shape=box, style="rounded,filled", fillcolor=firebrick];\n')
+        for node in G:
+            f.write('  ' + quote(node) + ';\n')
+        for u, v, color in G.edges(data='edge_color', default='black'):
+            f.write('  ' + quote(u) + ' -> ' + quote(v) + ' [color=' + quote(color) + ', penwidth=3];\n')
+        f.write('}\n')
+
+# Returns the SVG markup of G drawn at the positions in pos, scaled to fit a width x height canvas, with edges in their edge colors and labels boxed like the rendered map
+def svgMarkup(G, pos, width=1500, height=1500, margin=60):
+    xs = [x for x, y in pos.values()] or [0]
+    ys = [y for x, y in pos.values()] or [0]
+    scaleX = (width - 2*margin) / ((max(xs) - min(xs)) or 1)
+    scaleY = (height - 2*margin) / ((max(ys) - min(ys)) or 1)
+    def point(node):
+        x, y = pos[node]
+        return (margin + (x - min(xs)) * scaleX, height - margin - (y - min(ys)) * scaleY) # SVG's y axis points down
+    points = {node : point(node) for node in G}
+    widths = {node : 7*len(str(node)) + 8 for node in G} # rough label widths, since SVG can't size a box to its text
+    colors = sorted({color for u, v, color in G.edges(data='edge_color', default='black')})
+    lines = ['<svg xmlns="http://www.w3.org/2000/svg" width="' + str(width) + '" height="' + str(height) + '" viewBox="0 0 ' + str(width) + ' ' + str(height) + '" font-family="sans-serif" font-size="12">', '<defs>']
+    for i, color in enumerate(colors): # one arrowhead per edge color
+        lines.append('<marker id="arrow' + str(i) + '" viewBox="0 0 10 10" refX="10" refY="5" markerWidth="4" markerHeight="4" orient="auto"><path d="M0,0L10,5L0,10z" fill="' + html.escape(color) + '"/></marker>')
+    lines.append('</defs>')
+    markers = {color : 'url(#arrow' + str(i) + ')' for i, color in enumerate(colors)}
+    for u, v, color in G.edges(data='edge_color', default='black'):
+        (x1, y1), (x2, y2) = points[u], points[v]
+        dx, dy = x2 - x1, y2 - y1
+        t = min(widths[v]/2 / abs(dx) if dx else math.inf, 9 / abs(dy) if dy else math.inf) # fraction of the edge inside the target's label box, which would otherwise cover the arrowhead
+        if t < 1:
+            x2, y2 = x2 - dx*t, y2 - dy*t
+        lines.append('<line x1="%.1f" y1="%.1f" x2="%.1f" y2="%.1f" stroke="%s" stroke-width="3" marker-end="%s"/>' % (x1, y1, x2, y2, html.escape(color), markers[color]))
+    for node, (x, y) in points.items():
+        label = html.escape(str(node))
+        w = widths[node]
+        lines.append('<g><title>%s</title><rect x="%.1f" y="%.1f" width="%d" height="18" rx="4" fill="firebrick" stroke="black"/><text x="%.1f" y="%.1f" text-anchor="middle">%s</text></g>' % (label, x - w/2, y - 9, w, x, y + 4, label))
+    lines.append('</svg>')
+    return '\n'.join(lines)
+
+# Writes G as a standalone SVG file on a canvas of size (width, height) inches, skipping matplotlib entirely
+def writeSvg(G, pos, path, size=(15,15)):
+    with open(path, 'w') as f:
+        f.write(svgMarkup(G, pos, int(size[0]*100), int(size[1]*100)))
+
+# Writes G as a self-contained HTML page around the SVG map, which can be panned by dragging and zoomed with the mouse wheel
+def writeHtml(G, pos, path, size=(15,15)):
+    with open(path, 'w') as f:
+        f.write('''<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Server Map</title>
+<style>html, body { margin: 0; height: 100%; overflow: hidden; } svg { width: 100%; height: 100%; cursor: grab; }</style>
+</head><body>
+''' + svgMarkup(G, pos, int(size[0]*100), int(size[1]*100)) + '''
+<script>
+const svg = document.querySelector('svg');
+let box = svg.viewBox.baseVal, drag = null;
+svg.addEventListener('wheel', e => {
+  e.preventDefault();
+  const k = e.deltaY > 0 ? 1.2 : 1/1.2, r = svg.getBoundingClientRect();
+  const x = box.x + (e.clientX - r.left) / r.width * box.width, y = box.y + (e.clientY - r.top) / r.height * box.height;
+  box.x = x - (x - box.x) * k; box.y = y - (y - box.y) * k; box.width *= k; box.height *= k;
+});
+svg.addEventListener('mousedown', e => { drag = [e.clientX, e.clientY]; });
+window.addEventListener('mouseup', () => { drag = null; });
+window.addEventListener('mousemove', e => {
+  if (!drag) return;
+  const r = svg.getBoundingClientRect();
+  box.x -= (e.clientX - drag[0]) / r.width * box.width; box.y -= (e.clientY - drag[1]) / r.height * box.height;
+  drag = [e.clientX, e.clientY];
+});
+</script>
+</body></html>
+''')
+
+layoutMethods = ['dot', 'layered', 'sfdp', 'spring']
+
+# Returns a dict of node -> (x, y) position for G. "dot" and "sfdp" use graphviz through pygraphviz, falling back to the built-in "layered" layout when it isn't installed; "spring" is networkx's force-directed layout
+def layoutGraph(G, method='dot'):
+    import networkx as nx
+    if method in ('dot', 'sfdp'):
+        try:
+            return nx.drawing.nx_agraph.graphviz_layout(G, prog=method, args="-Grankdir=LR" if method == 'dot' else '')
+        except ImportError:
+            warnings.warn('pygraphviz is not installed, using the layered layout instead of ' + method)
+            method = 'layered'
+    if method == 'spring':
+        return nx.spring_layout(G, seed=0)
+    if method == 'layered':
+        return layeredLayout(G)
+    raise ValueError('Unknown layout "' + method + '", expected one of [' + ', '.join(layoutMethods) + ']')
+
+# Lays out G reusing the node positions stored in the JSON file at cachePath, so only nodes missing from it are placed: each beside the average position of its already placed neighbors (one rank step right of its inputs or left of its outputs), or in a new column when it has none. The full layout only runs when no cached position applies. Writes the positions back to cachePath
+def cachedLayout(G, method, cachePath):
+    try:
+        with open(cachePath, 'r') as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        cached = {}
+    pos = {node : tuple(cached[node]) for node in G if node in cached}
+    if not pos:
+        pos = layoutGraph(G, method)
+    elif len(pos) < len(G):
+        gaps = sorted(abs(pos[u][0] - pos[v][0]) for u, v in G.edges() if u in pos and v in pos and pos[u][0] != pos[v][0])
+        step = gaps[len(gaps) // 2] if gaps else 1.0 # median horizontal distance between connected nodes, i.e. one rank
+        ys = sorted(y for x, y in pos.values())
+        spacing = max((ys[-1] - ys[0]) / max(len(ys) - 1, 1), step / 4) # keeps nodes sharing a spot apart
+        taken = {(round(x, 6), round(y, 6)) for x, y in cached.values()} # exact positions in use, including those of cached nodes missing from this graph so they can return to them, rounded only to absorb float noise
+        def place(node, x, y): # moves down one spacing at a time until the position is free
+            while (round(x, 6), round(y, 6)) in taken:
+                y += spacing
+            pos[node] = (x, y)
+            taken.add((round(x, 6), round(y, 6)))
+        pending = [node for node in G if node not in pos]
+        while pending:
+            stuck = []
+            for node in pending:
+                spots = [(pos[u][0] + step, pos[u][1]) for u in G.predecessors(node) if u in pos] + [(pos[v][0] - step, pos[v][1]) for v in G.successors(node) if v in pos]
+                if not spots:
+                    stuck.append(node)
+                    continue
+                x = sum(spot[0] for spot in spots) / len(spots)
+                y = sum(spot[1] for spot in spots) / len(spots)
+                place(node, x, y)
+            if len(stuck) == len(pending): # nothing left connects to a placed node, so stack the rest in a new column
+                right = max(x for x, y in pos.values()) + step
+                for node in stuck:
+                    place(node, right, ys[0])
+                break
+            pending = stuck
+    with open(cachePath, 'w') as f:
+        json.dump({**cached, **{str(node) : [float(x), float(y)] for node, (x, y) in pos.items()}}, f) # keeps nodes missing from this graph where they were
+    return pos
+
+# A Sugiyama-style layered layout drawn left to right like dot's rankdir=LR: back edges of any cycles are reversed, nodes are ranked by longest path from the sources, and each rank is reordered by the barycenter of its neighbors over a few sweeps to reduce crossings. Every step runs over NumPy edge arrays, one rank at a time
+def layeredLayout(G, sweeps=4):
+    import numpy as np
+    names = list(G)
+    n = len(names)
+    if not n:
+        return {}
+    ids = {name : i for i, name in enumerate(names)}
+    src = np.array([ids[u] for u, v in G.edges()], dtype=np.int64)
+    dst = np.array([ids[v] for u, v in G.edges()], dtype=np.int64)
+
+    # Breaks cycles by reversing every edge that points back up an iterative depth-first ordering
+    rank = np.empty(n, dtype=np.int64)
+    seen = np.zeros(n, dtype=bool)
+    counter = 0
+    for root in range(n):
+        if seen[root]:
+            continue
+        seen[root] = True
+        stack = [(root, iter(G.successors(names[root])))]
+        while stack:
+            node, successors = stack[-1]
+            for successor in successors:
+                s = ids[successor]
+                if not seen[s]:
+                    seen[s] = True
+                    stack.append((s, iter(G.successors(successor))))
+                    break
+            else:
+                stack.pop()
+                rank[node] = counter # finishing order, so every forward or cross edge goes from a higher to a lower rank
+                counter += 1
+    back = rank[src] <= rank[dst] # includes self loops, which are then dropped
+    src, dst = np.where(back, dst, src), np.where(back, src, dst)
+    keep = src != dst
+    src, dst = src[keep], dst[keep]
+
+    # Longest path layering, releasing a whole frontier of nodes per layer
+    order = np.argsort(src, kind='stable')
+    sortedDst = dst[order]
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(src, minlength=n))))
+    indegree = np.bincount(dst, minlength=n)
+    layer = np.zeros(n, dtype=np.int64)
+    frontier = np.flatnonzero(indegree == 0)
+    depth = 0
+    while frontier.size:
+        layer[frontier] = depth
+        starts, lengths = indptr[frontier], indptr[frontier + 1] - indptr[frontier]
+        edges = np.arange(lengths.sum()) + np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        targets = sortedDst[edges]
+        np.subtract.at(indegree, targets, 1)
+        frontier = np.unique(targets[indegree[targets] == 0])
+        depth += 1
+
+    # Barycenter crossing reduction, alternating downward and upward sweeps
+    position = np.zeros(n, dtype=np.float64)
+    layers = [np.flatnonzero(layer == l) for l in range(depth)]
+    for nodes in layers:
+        position[nodes] = np.arange(nodes.size)
+    for sweep in range(sweeps):
+        downward = sweep % 2 == 0
+        for l in (range(1, depth) if downward else range(depth - 2, -1, -1)):
+            nodes = layers[l]
+            neighbor, node = (src, dst) if downward else (dst, src)
+            mask = (layer[node] == l) & ((layer[neighbor] < l) if downward else (layer[neighbor] > l))
+            weights = np.bincount(node[mask], weights=position[neighbor[mask]], minlength=n)[nodes]
+            counts = np.bincount(node[mask], minlength=n)[nodes]
+            barycenter = np.where(counts > 0, weights / np.maximum(counts, 1), position[nodes]) # unconnected nodes hold their place
+            nodes = nodes[np.argsort(barycenter, kind='stable')]
+            layers[l] = nodes
+            position[nodes] = np.arange(nodes.size)
+
+    pos = {}
+    for l, nodes in enumerate(layers):
+        for p, i in enumerate(nodes):
+            pos[names[i]] = (float(l), float((nodes.size - 1) / 2 - p))
+    return pos
+
+# Returns a value that changes whenever the file at path is modified, or None if it doesn't exist
+def fileSignature(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+# Maps the filename of every server config to its path so each reference in the environment config resolves with one lookup. Filenames given more than once are reported and resolve to their first path; returns the index and a dict of the collisions
+def indexServers(paths):
+    index = {}
+    collisions = {}
+    for path in paths:
+        base = os.path.split(path)[-1]
+        if base in index:
+            collisions.setdefault(base, [index[base]]).append(path)
         else:
-            warnings.warn('File "' + filename + '" of unknown type')
+            index[base] = path
+    for base, dupes in collisions.items():
+        warnings.warn('Server config "' + base + '" given more than once: [' + ', '.join(dupes) + '], using ' + dupes[0])
+    return index, collisions
+
+# Reads and parses a single server config file, through the parse cache if one is given. Lives at module level so it can be sent to worker processes
+def parseServerFile(filename, cache=None):
+    if cache:
+        return cache.load(filename)
+    import pyhocon # deferred so runs that never read a server config (--load-snapshot, --diff) skip importing pyhocon and pyparsing; cache hits still import both when unpickling the ConfigTree
+    with open(filename, 'r') as f:
+        return pyhocon.ConfigFactory.parse_string(f.read())
+
+# Parses a single server config file like parseServerFile, returning the parsed config along with the seconds it took so that parse times can be collected from worker processes
+def timedParseServerFile(filename, cache=None):
+    start = time.perf_counter()
+    data = parseServerFile(filename, cache)
+    return data, time.perf_counter() - start
+
+# Parses every file in filenames, spread across a pool of "jobs" processes when there is more than one, and returns a dict of each filename to its parsed config in the order given. Records the parse time of each file while timings are enabled
+def parseServerFiles(filenames, cache=None, jobs=1):
+    parse = timedParseServerFile if timings.enabled else parseServerFile
+    if jobs > 1 and len(filenames) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+            chunksize = max(1, len(filenames) // (jobs * 4)) # batches small files together to cut down on pickling round trips
+            results = dict(zip(filenames, pool.map(parse, filenames, itertools.repeat(cache), chunksize=chunksize)))
+    else:
+        results = {filename : parse(filename, cache) for filename in filenames}
+    if timings.enabled:
+        for filename, (data, seconds) in results.items():
+            timings.parses[filename] = seconds
+            results[filename] = data
+    return results
+
+# Handles identification of server type based on the contents of the config file and returns the corresponding treeElement. Already parsed contents may be passed as "data" to skip reading the file
+def serverConstructor(name, filename, buildNum, cache=None, data=None):
+    start = time.perf_counter()
+    name = re.sub(r'_CONF', '', name)
+    if data is None:
+        data = parseServerFile(filename, cache)
+    if 'logstreams' in data:
+        element = ApiElement(name, data, buildNum)
+    elif 'packed' in data:
+        element = StreamElement(name, data, buildNum)
+    else:
+        warnings.warn('File "' + filename + '" of unknown type')
+        return None
+    element.sourcePath = filename
+    element.sourceCache = cache
+    if timings.enabled:
+        timings.constructors.append((name, filename, time.perf_counter() - start))
+    return element
+
+# Collects the wall clock time of each stage of a run, each server config parse and each serverConstructor call while enabled, for --profile. Disabled, a stage costs two clock reads
+class Timings:
+    def __init__(self):
+        self.enabled = False
+        self.stages = [] # (stage, environment, seconds) in the order they finished
+        self.parses = {} # server config path -> seconds, from whichever process parsed it
+        self.constructors = [] # (server, server config path, seconds)
+
+    # Times the body of a with statement as one run of stage for environment
+    @contextlib.contextmanager
+    def stage(self, name, environment=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.enabled:
+                self.stages.append((name, environment, time.perf_counter() - start))
+
+    # Returns every timing as a JSON-ready dict, with the total of each stage and the parses and constructions sorted slowest first so pathological server configs stand out
+    def report(self):
+        totals = {}
+        for name, _, seconds in self.stages:
+            totals[name] = totals.get(name, 0) + seconds
+        return {
+            'totals' : totals,
+            'stages' : [{'stage' : name, 'environment' : environment, 'seconds' : seconds} for name, environment, seconds in self.stages],
+            'parses' : [{'file' : path, 'seconds' : seconds} for path, seconds in sorted(self.parses.items(), key=lambda p: -p[1])],
+            'constructors' : [{'server' : server, 'file' : path, 'seconds' : seconds} for server, path, seconds in sorted(self.constructors, key=lambda c: -c[2])],
+        }
+
+timings = Timings()
+
+# An on-disk store of parsed server configs, keyed by a hash of each file's contents so that unchanged files are unpickled instead of reparsed. Least recently used entries are evicted once the directory grows past maxBytes
+class ParseCache:
+    version = b'1' # bump whenever the pickled layout changes so stale entries are ignored
+
+    def __init__(self, directory, maxBytes):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        os.makedirs(directory, exist_ok=True)
+
+    # Returns the parsed config tree of filename, only invoking pyhocon when its contents have no cache entry
+    def load(self, filename):
+        with open(filename, 'rb') as f:
+            raw = f.read()
+        entry = os.path.join(self.directory, hashlib.sha256(self.version + raw).hexdigest() + '.pickle')
+        try:
+            with open(entry, 'rb') as f:
+                data = pickle.load(f)
+            os.utime(entry) # marks the entry as recently used for eviction
+            return data
+        except (OSError, EOFError, pickle.UnpicklingError):
+            pass
+        import pyhocon
+        data = pyhocon.ConfigFactory.parse_string(raw.decode())
+        tmp = entry + '.' + str(os.getpid()) + '.tmp' # written aside and renamed so concurrent runs never read a partial entry
+        with open(tmp, 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, entry)
+        return data
+
+    # Deletes the least recently used entries until the cache fits within maxBytes
+    def evict(self):
+        entries = []
+        with os.scandir(self.directory) as it:
+            for e in it:
+                if e.name.endswith('.pickle'):
+                    st = e.stat()
+                    entries.append((st.st_mtime, st.st_size, e.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.maxBytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
 
 # Overrides the default python JSON encoder to serialze timedelta information stored in config files
 class CustomJSONEncoder(json.JSONEncoder):
@@ -87,115 +831,469 @@ class CustomJSONEncoder(json.JSONEncoder):
         if isinstance(obj, timedelta) or isinstance(obj, relativedelta.relativedelta):
             return str(obj)
         if isinstance(obj, TreeElement):
-            return print(obj)
+            return obj.serialize()
         # Add more custom serialization logic here for other types if needed
         return super().default(obj)
 
-# Essentially a paired list of regular expressions, where "formats" are replaced with their corresponding "mutation" to match multiple config files with related environment information
+# Writes nodes to a compact binary snapshot: a header, a table of every distinct string, a table of nodes and a table of edges, all little-endian int32 arrays so they can be memory-mapped straight back in. Each node is a fixed row of string indices (type, name, nickname, JSON-encoded build number and list field, i.e. partitions or groups) and a visibility flag, and each edge an (input, node, input group, output group) row, the groups being the StreamElement inputGroups and KafkaTopic outputGroups entries of that edge; -1 marks an empty field. Edges are grouped by node in the order of its inputs, so they are followed by a table of every edge's row number in the order of the inputs' outputs, letting both be rebuilt as they were. When a GraphStore of the nodes is given, the edges are taken from its arrays instead of walking every node's inputs. Returns the number of nodes and edges written
+def writeSnapshot(nodes, path, store=None):
+    strings = {}
+    def intern(string):
+        return strings.setdefault(string, len(strings))
+    def field(value): # build numbers and lists repeat across nodes, so each distinct one is encoded (and decoded) once
+        return intern(json.dumps(value, cls=CustomJSONEncoder)) if value is not None else -1
+    elements = list(nodes.values())
+    nodeTable = array.array('i')
+    for nickname, node in nodes.items():
+        listField = getattr(node, 'partitions', None) if isinstance(node, ApiElement) else node.groups if isinstance(node, StreamElement) else None
+        nodeTable.extend([intern(type(node).__name__), intern(node.name), intern(nickname), field(getattr(node, 'buildNum', None)), field(list(listField) if listField is not None else None), int(node.isVisible)])
+    if store is not None and store.nodes is nodes: # store ids follow the same nodes order
+        edges = zip(store.src.tolist(), store.dst.tolist())
+    else:
+        ids = {nickname : i for i, nickname in enumerate(nodes)}
+        edges = [(ids[i.nickname], j) for j, node in enumerate(elements) for i in node.inputs.values() if i.nickname in ids]
+    edgeTable = array.array('i')
+    ranks = {} # input id -> {output key : its place among the input's outputs}, built as each input is first reached
+    outputOrder = []
+    for i, j in edges:
+        source, target = elements[i], elements[j]
+        if i not in ranks:
+            ranks[i] = {key : rank for rank, key in enumerate(source.outputs)}
+        outputOrder.append((i, ranks[i].get(target.key, -1), len(outputOrder)))
+        inputGroup = target.inputGroups.get(source.nickname) if isinstance(target, StreamElement) else None
+        outputGroup = source.outputGroups.get(target.nickname) if isinstance(source, KafkaTopic) else None
+        edgeTable.extend([i, j, intern(inputGroup) if inputGroup is not None else -1, intern(outputGroup) if outputGroup is not None else -1])
+    orderTable = array.array('i', [e for _, _, e in sorted(outputOrder)])
+    blob = bytearray()
+    offsets = array.array('i', [0])
+    for string in strings:
+        blob += string.encode()
+        offsets.append(len(blob))
+    blob += bytes(-len(blob) % 4) # keeps the following tables 4-byte aligned for memoryview casts
+    if sys.byteorder == 'big':
+        for table in (offsets, nodeTable, edgeTable, orderTable):
+            table.byteswap()
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<4sIIIII', snapshotMagic, snapshotVersion, len(strings), len(nodes), len(orderTable), len(blob)))
+        f.write(offsets.tobytes())
+        f.write(blob)
+        f.write(nodeTable.tobytes())
+        f.write(edgeTable.tobytes())
+        f.write(orderTable.tobytes())
+    return len(nodes), len(orderTable)
+
+snapshotMagic = b'SMAP'
+snapshotVersion = 3
+nodeTypes = {} # type name -> TreeElement subclass, filled in below the class definitions
+
+# Memory-maps a snapshot written by writeSnapshot and rebuilds its dict of nodes without touching any environment or server config. Nodes are created with blankElement and linked by filling in their inputs and outputs directly, so no constructor, populateIO or per-edge generation bump runs
+def readSnapshot(path):
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        header = struct.calcsize('<4sIIIII')
+        magic, version, nStrings, nNodes, nEdges, blobSize = struct.unpack_from('<4sIIIII', mm)
+        if magic != snapshotMagic or version != snapshotVersion:
+            raise ValueError('"' + path + '" is not a version ' + str(snapshotVersion) + ' server map snapshot')
+        def table(start, count):
+            view = memoryview(mm)[start:start + 4*count]
+            if sys.byteorder == 'big':
+                swapped = array.array('i', view)
+                view.release()
+                swapped.byteswap()
+                return swapped.tolist()
+            values = view.cast('i')
+            rows = values.tolist()
+            values.release()
+            view.release() # mmap can't close while views of it are still exported
+            return rows
+        offsets = table(header, nStrings + 1)
+        blobStart = header + 4*(nStrings + 1)
+        blob = mm[blobStart:blobStart + blobSize]
+        strings = [blob[offsets[i]:offsets[i+1]].decode() for i in range(nStrings)]
+        nodeTable = table(blobStart + blobSize, 6*nNodes)
+        edgeTable = table(blobStart + blobSize + 24*nNodes, 4*nEdges)
+        orderTable = table(blobStart + blobSize + 24*nNodes + 16*nEdges, nEdges)
+    decoded = {}
+    types = {}
+    elements = []
+    for typeName, name, nickname, buildNum, listField, visible in zip(*(nodeTable[i::6] for i in range(6))):
+        for j in (buildNum, listField):
+            if j >= 0 and j not in decoded:
+                decoded[j] = json.loads(strings[j])
+        if typeName not in types:
+            types[typeName] = nodeTypes[strings[typeName]]
+        element = blankElement(types[typeName], strings[name], strings[nickname], bool(visible))
+        if buildNum >= 0:
+            element.buildNum = decoded[buildNum]
+        if listField >= 0:
+            if isinstance(element, ApiElement):
+                element.partitions = list(decoded[listField])
+            else:
+                element.groups = list(decoded[listField])
+        elements.append(element)
+    keys = [element.key for element in elements]
+    sources, targets = edgeTable[0::4], edgeTable[1::4]
+    for s, t, inputGroup, outputGroup in zip(sources, targets, edgeTable[2::4], edgeTable[3::4]):
+        source, target = elements[s], elements[t]
+        target.inputs[keys[s]] = source
+        if inputGroup >= 0:
+            target.inputGroups[source.nickname] = strings[inputGroup]
+        if outputGroup >= 0:
+            source.outputGroups[target.nickname] = strings[outputGroup]
+    for e in orderTable:
+        t = targets[e]
+        elements[sources[e]].outputs[keys[t]] = elements[t]
+    TreeElement.generation += 1
+    return {element.nickname : element for element in elements}
+
+# Creates a node of type cls without running its constructor, so it has no source, no edges and every subclass field empty
+def blankElement(cls, name, nickname, visible):
+    element = cls.__new__(cls)
+    element.name = sys.intern(name)
+    element.nickname = sys.intern(nickname)
+    element._source = None
+    element.sourcePath = None
+    element.sourceCache = None
+    element._isVisible = visible
+    element.inputs = {}
+    element.outputs = {}
+    element.provenance = {}
+    element.collapsedInto = None
+    element.graphId = None
+    element._visibleInputs = (-1, None)
+    element._visibleOutputs = (-1, None)
+    if issubclass(cls, (ApiElement, StreamElement)):
+        element.buildNum = -1
+    if issubclass(cls, ApiElement):
+        element.partitions = []
+    if issubclass(cls, StreamElement):
+        element.groups = []
+        element.inputGroups = {}
+    if issubclass(cls, KafkaTopic):
+        element.outputGroups = {}
+    return element
+
+# Recreates a node from its serialized fields, with an empty source since architecture files don't keep configs
+def restoreElement(typeName, name, nickname, extras, visible):
+    element = blankElement(nodeTypes[typeName], name, nickname, visible)
+    for attr, value in extras.items():
+        setattr(element, attr, value)
+    TreeElement.generation += 1
+    return element
+
+# A frozen, array-backed copy of a graph of nodes: each node is given an integer id (its index in "elements", also set as its graphId) and edges are held as NumPy CSR arrays in both directions, so traversals, statistics and export run as array operations instead of walking inputs and outputs object by object
+class GraphStore:
+    def __init__(self, nodes):
+        import numpy as np
+        self.generation = TreeElement.generation # the graph state this store reflects
+        self.nodes = nodes # and the nodes dict it was built from, whose order its ids follow
+        self.elements = list(nodes.values())
+        self.ids = {nickname : i for i, nickname in enumerate(nodes)}
+        src = []
+        dst = []
+        for i, node in enumerate(self.elements):
+            node.graphId = i
+            for element in node.inputs.values():
+                j = self.ids.get(element.nickname)
+                if j is not None:
+                    src.append(j)
+                    dst.append(i)
+        n = len(self.elements)
+        self.src = np.array(src, dtype=np.int32)
+        self.dst = np.array(dst, dtype=np.int32)
+        self.forward = self.compress(self.src, self.dst, n) # (indptr, indices) of each node's outputs
+        self.reverse = self.compress(self.dst, self.src, n) # (indptr, indices) of each node's inputs
+
+    # Packs edges as compressed sparse rows: the neighbors of node i are indices[indptr[i]:indptr[i+1]]
+    @staticmethod
+    def compress(rows, columns, n):
+        import numpy as np
+        order = np.argsort(rows, kind='stable')
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=n), out=indptr[1:])
+        return indptr, columns[order]
+
+    def __len__(self):
+        return len(self.elements)
+
+    # Returns the ids of a node's outputs
+    def successors(self, i):
+        indptr, indices = self.forward
+        return indices[indptr[i]:indptr[i+1]]
+
+    # Returns the ids of a node's inputs
+    def predecessors(self, i):
+        indptr, indices = self.reverse
+        return indices[indptr[i]:indptr[i+1]]
+
+    # Returns arrays of every node's input and output counts
+    def degrees(self):
+        import numpy as np
+        return np.diff(self.reverse[0]), np.diff(self.forward[0])
+
+    # Returns a boolean mask of every node reachable from the ids in sources, following outputs (or inputs when downstream is False). Expands a whole frontier per step
+    def reachable(self, sources, downstream=True):
+        import numpy as np
+        indptr, indices = self.forward if downstream else self.reverse
+        seen = np.zeros(len(self.elements), dtype=bool)
+        frontier = np.unique(np.asarray(sources, dtype=np.int64))
+        seen[frontier] = True
+        while frontier.size:
+            starts, lengths = indptr[frontier], indptr[frontier + 1] - indptr[frontier]
+            edges = np.arange(lengths.sum()) + np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+            targets = np.unique(indices[edges])
+            frontier = targets[~seen[targets]]
+            seen[frontier] = True
+        return seen
+
+    # Returns a dict of summary statistics: node and edge counts, nodes per type, in/out degree extremes and means, source and sink counts, and the highest degree hubs
+    def stats(self, hubs=10):
+        import numpy as np
+        inDegree, outDegree = self.degrees()
+        total = inDegree + outDegree
+        types = {}
+        for element in self.elements:
+            types[type(element).__name__] = types.get(type(element).__name__, 0) + 1
+        top = np.argsort(-total, kind='stable')[:hubs]
+        return {'nodes' : len(self.elements), 'edges' : int(self.src.size), 'types' : types,
+                'maxInDegree' : int(inDegree.max(initial=0)), 'maxOutDegree' : int(outDegree.max(initial=0)), 'meanDegree' : float(total.mean()) if total.size else 0.0,
+                'sources' : int(np.count_nonzero((inDegree == 0) & (outDegree > 0))), 'sinks' : int(np.count_nonzero((outDegree == 0) & (inDegree > 0))),
+                'hubs' : [[self.elements[i].nickname, int(inDegree[i]), int(outDegree[i])] for i in top if total[i]]}
+
+# Loads the nodes of an architecture from either a binary snapshot or an architecture JSON file written by exportJSON
+def readArchitecture(path):
+    with open(path, 'rb') as f:
+        isSnapshot = f.read(len(snapshotMagic)) == snapshotMagic
+    if isSnapshot:
+        return readSnapshot(path)
+    with open(path, 'r') as f:
+        records = json.load(f)
+    core = ('id', 'type', 'name', 'visible', 'inputs', 'outputs')
+    nodes = {}
+    for nickname, record in records.items():
+        nodes[nickname] = restoreElement(record['type'], record['name'], nickname, {k : v for k, v in record.items() if k not in core}, record['visible'])
+    for nickname, record in records.items():
+        for i in record['inputs']:
+            if i in nodes:
+                nodes[nickname].addInput(nodes[i])
+                nodes[i].addOutput(nodes[nickname])
+    return nodes
+
+# Compares two dicts of nodes by their hashed identity keys and returns the added and removed nodes and edges, along with any changed build numbers or stream groups, in a single pass over each. Edges into a stream carry the group they are read in as a third item, so an edge moving to another group (and so changing color) shows up as removed and re-added
+def diffArchitectures(old, new):
+    def index(nodes):
+        keyed = {node.key : node for node in nodes.values()}
+        edges = set()
+        for node in nodes.values():
+            groups = getattr(node, 'inputGroups', {})
+            for i in node.inputs.values():
+                edges.add((i.nickname, node.nickname) + ((groups[i.nickname],) if i.nickname in groups else ()))
+        return keyed, edges
+    oldNodes, oldEdges = index(old)
+    newNodes, newEdges = index(new)
+    diff = {'addedNodes' : sorted(newNodes[k].nickname for k in newNodes.keys() - oldNodes.keys()),
+            'removedNodes' : sorted(oldNodes[k].nickname for k in oldNodes.keys() - newNodes.keys()),
+            'addedEdges' : sorted(newEdges - oldEdges),
+            'removedEdges' : sorted(oldEdges - newEdges),
+            'buildChanges' : {},
+            'groupChanges' : {}}
+    for key in oldNodes.keys() & newNodes.keys():
+        o, n = oldNodes[key], newNodes[key]
+        if getattr(o, 'buildNum', None) != getattr(n, 'buildNum', None):
+            diff['buildChanges'][n.nickname] = [getattr(o, 'buildNum', None), getattr(n, 'buildNum', None)]
+        if getattr(o, 'groups', None) != getattr(n, 'groups', None):
+            diff['groupChanges'][n.nickname] = [getattr(o, 'groups', None), getattr(n, 'groups', None)]
+    return diff
+
+# Essentially a paired list of regular expressions, where "formats" are replaced with their corresponding "mutation" to match multiple config files with related environment information. Formats are matched as key suffixes, and are compiled once up front
 class NamingScheme():
     def __init__(self, **regexes):
         self.formats = regexes['formats']
         self.mutations = dict(zip(self.formats,regexes['mutations']))
+        self.patterns = [(re.compile('(.*)' + f + '$'), self.mutations[f]) for f in self.formats]
+
+    # yields the mutated form of key for every format it ends with
+    def mutate(self, key):
+        for pattern, mutation in self.patterns:
+            match = pattern.match(key)
+            if match:
+                yield match.group(1) + mutation
+
+    # returns the keys matching any format
+    def formatKeys(self, keys):
+        return [key for key in keys if any(pattern.match(key) for pattern, _ in self.patterns)]
 
     # searches through some list keys for any values matching a format, returns a list of any extant formats and mutated matches
     def dumpMatches(self, keys):
+        index = set(keys) # mutated keys are looked up directly instead of rescanning every key
         matches = []
         for key in keys:
-            for f in self.formats:
-                if re.search(f, key):
-                    matches.append(key)
-                    subSearch = re.sub(f, self.mutations[f], key)
-                    for m in keys:
-                        if re.search(subSearch, m):
-                            matches.append(m)
+            for mutKey in self.mutate(key):
+                matches.append(key)
+                if mutKey in index:
+                    matches.append(mutKey)
         return matches
 
     # searches through some dict "source" given some subset of its keys "keys" and returns a dict of all matches of it and its mutations
     def matchKeys(self, source, keys):
         matches = []
-        for i in range(len(keys)):
-            matches.append({keys[i] : source[keys[i]]})
-            for f in self.formats:
-                mutKey = re.sub(f, self.mutations[f], keys[i])
-                for s in list(source):
-                    if re.search(mutKey, s):
-                        matches[i].update({s : source[s]})
+        for key in keys:
+            matches.append({key : source[key]})
+            for mutKey in self.mutate(key):
+                if mutKey in source:
+                    matches[-1].update({mutKey : source[mutKey]})
         return matches
 
 # A generic class for a node in the overall graph
 class TreeElement:
+    __slots__ = ('name', 'nickname', '_source', 'sourcePath', 'sourceCache', '_isVisible', 'inputs', 'outputs', 'provenance', 'collapsedInto', 'graphId', '_visibleInputs', '_visibleOutputs') # no per-node __dict__, since fleet maps hold hundreds of thousands of nodes
+    generation = 0 # bumped whenever any node's edges or visibility change, invalidating every memoized getInputs/getOutputs result
+
     def __init__(self, name, source, isVisible=True):
-        self.name = name
-        self.nickname = name
-        self.source = source
-        self.isVisible = isVisible
-        self.inputs = []
-        self.outputs = []
-
-    # Checks for equal type, then each non-list element, then the names of inputs and outputs (if the inputs and outputs themselves were compared, there's an infinite loop). Does not account for any subclass attributes
+        self.name = sys.intern(name) if isinstance(name, str) else name # names repeat across every server referencing a topic, so share one string
+        self.nickname = self.name
+        self._source = source or None
+        self.sourcePath = None # config file the source was parsed from, so a released source can be reloaded
+        self.sourceCache = None # ParseCache to reload it through, if any
+        self._isVisible = isVisible
+        self.inputs = {} # insertion-ordered sets of neighbors, as dicts keyed by each neighbor's identity key
+        self.outputs = {}
+        self.provenance = {} # neighbor identity key -> set of what contributed the edge(s) with that neighbor, e.g. server config paths
+        self.collapsedInto = None # while invisible, an aggregate node to stand in for this one instead of its own neighbors
+        self.graphId = None # integer id in the last GraphStore built from this node's graph
+        self._visibleInputs = (-1, None) # (generation, visible inputs) as of the last getInputs call
+        self._visibleOutputs = (-1, None)
+
+    # The parsed config this node was built from. Once released, it is reloaded from sourcePath on every access rather than kept in memory: unpickled from sourceCache when there is one, and otherwise fully reparsed with pyhocon, so callers reading several fields should hold on to the returned config
+    @property
+    def source(self):
+        if self._source is None and self.sourcePath is not None:
+            return parseServerFile(self.sourcePath, self.sourceCache)
+        return self._source if self._source is not None else {}
+
+    @source.setter
+    def source(self, value):
+        self._source = value or None
+
+    # Drops the reference to the parsed source config, which is by far the largest part of a server node, once populateIO no longer needs it
+    def releaseSource(self):
+        self._source = None
+
+    @property
+    def isVisible(self):
+        return self._isVisible
+
+    @isVisible.setter
+    def isVisible(self, value):
+        self._isVisible = value
+        TreeElement.generation += 1
+
+    # A node's identity is its type and nickname, which is also what the graph is drawn by, so equality and hashing never need to walk inputs or outputs
+    @property
+    def key(self):
+        return (type(self).__name__, self.nickname)
+
     def __eq__(self, other):
-        if isinstance(other, type(self)):
-            if self.name == other.name and self.source == other.source and self.isVisible == other.isVisible and len(self.inputs)==len(other.inputs) and len(self.outputs)==len(other.outputs):
-                sInputs = []
-                oInputs = []
-                for i in range(len(self.inputs)):
-                    sInputs.append(self.inputs[i].name)
-                    oInputs.append(other.inputs[i].name)
-                sOutputs = []
-                oOutputs = []
-                for i in range(len(self.outputs)):
-                    sOutputs.append(self.outputs[i].name)
-                    oOutputs.append(other.outputs[i].name)
-                return (sInputs.sort()==oInputs.sort() and sOutputs.sort()==oOutputs.sort())
-        return False
+        return isinstance(other, TreeElement) and self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
 
     def __str__(self):
         inputNames = []
-        for i in self.inputs:
+        for i in self.inputs.values():
             inputNames.append(i.name)
         outputNames = []
-        for i in self.outputs:
+        for i in self.outputs.values():
             outputNames.append(i.name)
         return 'Name: ' + self.name + '\nNickname: ' + self.nickname + '\nInputs: [' + ', '.join(inputNames) + ']\nOutputs: [' + ', '.join(outputNames) + ']\n'
 
+    # Returns the node as a dict of plain JSON types, with its inputs and outputs referenced by id (nickname) rather than nested. Subclasses add their own fields
+    def serialize(self):
+        return {'id' : self.nickname, 'type' : type(self).__name__, 'name' : self.name, 'visible' : self.isVisible, 'inputs' : [i.nickname for i in self.inputs.values()], 'outputs' : [o.nickname for o in self.outputs.values()]}
+
+    # Adds element to the inputs unless an equal one is already there, and returns whichever is stored
+    def addInput(self, element):
+        TreeElement.generation += 1
+        return self.inputs.setdefault(element.key, element)
+
+    # Adds element to the outputs unless an equal one is already there, and returns whichever is stored
+    def addOutput(self, element):
+        TreeElement.generation += 1
+        return self.outputs.setdefault(element.key, element)
+
+    # Points any input or output equal to element at element itself, so a merged node is shared by all of its neighbors instead of each holding its own copy
+    def relink(self, element):
+        TreeElement.generation += 1
+        if element.key in self.inputs:
+            self.inputs[element.key] = element
+        if element.key in self.outputs:
+            self.outputs[element.key] = element
+
     # Any subclass with a corresponding config document should override this with its own handler
     def populateIO(self):
         pass
 
-    # Returns a list of only visible inputs. If there are invisible input(s), it returns their visible inputs.
+    # Returns a list of only visible inputs. If there are invisible input(s), it returns their visible inputs. Memoized until the graph next changes
     def getInputs(self):
-        visibleInputs = []
-        for i in self.inputs:
-            if i.isVisible:
-                visibleInputs.append(i)
-            else:
-                for sub in i.getInputs():
-                    visibleInputs.append(sub)
-        return visibleInputs
+        if self._visibleInputs[0] != TreeElement.generation:
+            self._visibleInputs = (TreeElement.generation, self.resolveVisible('inputs'))
+        return list(self._visibleInputs[1])
 
-    # Returns a list of only visible outputs. If there are invisible output(s), it returns their visible outputs.
+    # Returns a list of only visible outputs. If there are invisible output(s), it returns their visible outputs. Memoized until the graph next changes
     def getOutputs(self):
-        visibleOutputs = []
-        for i in self.outputs:
-            if i.isVisible:
-                visibleOutputs.append(i)
-            else:
-                for sub in i.getOutputs():
-                    visibleOutputs.append(sub)
-        return visibleOutputs
+        if self._visibleOutputs[0] != TreeElement.generation:
+            self._visibleOutputs = (TreeElement.generation, self.resolveVisible('outputs'))
+        return list(self._visibleOutputs[1])
+
+    # Walks the "inputs" or "outputs" of this node, passing through invisible nodes until visible ones are reached. Each invisible node is expanded at most once, so chains of them never recurse deeply and cycles of them terminate
+    def resolveVisible(self, direction):
+        visible = {}
+        expanded = set()
+        stack = list(reversed(getattr(self, direction).values()))
+        while stack:
+            element = stack.pop()
+            if element.isVisible:
+                visible.setdefault(element.key, element)
+            elif element.collapsedInto is not None:
+                if element.collapsedInto is not self: # members of an aggregate don't link it to itself
+                    visible.setdefault(element.collapsedInto.key, element.collapsedInto)
+            elif element.key not in expanded:
+                expanded.add(element.key)
+                stack.extend(reversed(getattr(element, direction).values()))
+        return list(visible.values())
+
+    # Records that the edge(s) between this node and element were contributed by "contributor"
+    def contribute(self, element, contributor):
+        self.provenance.setdefault(element.key, set()).add(contributor)
 
-    # Adds any inputs/outputs of other not present in self to the input and output arrays, and then returns itself
+    # Withdraws contributor's claim on the edge(s) between this node and element, unlinking element once nothing else contributes them. Returns whether it was unlinked
+    def retract(self, element, contributor):
+        contributors = self.provenance.get(element.key, set())
+        contributors.discard(contributor)
+        if contributors:
+            return False
+        self.provenance.pop(element.key, None)
+        self.unlink(element)
+        return True
+
+    # Removes element from the inputs and outputs
+    def unlink(self, element):
+        TreeElement.generation += 1
+        self.inputs.pop(element.key, None)
+        self.outputs.pop(element.key, None)
+
+    # Adds any inputs/outputs of other not present in self to the input and output sets, and then returns itself
     def merge(self, other):
-        for element in other.inputs:
-            if element not in self.inputs:
-                self.inputs.append(element)
-        for element in other.outputs:
-            if element not in self.outputs:
-                self.outputs.append(element)
+        TreeElement.generation += 1
+        for key, element in other.inputs.items():
+            self.inputs.setdefault(key, element)
+        for key, element in other.outputs.items():
+            self.outputs.setdefault(key, element)
         return self
 
 # A TreeElement specified for the example API Server config document
 class ApiElement(TreeElement):
+    __slots__ = ('buildNum', 'partitions')
     keys = ['logstreams','persistence']
 
     def __init__(self, name, source, buildNum):
@@ -208,23 +1306,27 @@ class ApiElement(TreeElement):
         lines[2:2] = ['Build #: ' + str(self.buildNum)]
         return '\n'.join(lines)
 
+    def serialize(self):
+        data = super().serialize()
+        data.update({'buildNum' : self.buildNum, 'partitions' : list(getattr(self, 'partitions', []))})
+        return data
+
     def populateIO(self):
         if self.keys[0] in self.source:
             for stream in self.source[self.keys[0]]:
-                foundOutput = KafkaTopic(stream['create']['log.topic'], {})
-                self.outputs.append(foundOutput)
-                self.outputs[-1].inputs.append(self)
+                foundOutput = self.addOutput(KafkaTopic(stream['create']['log.topic'], {}))
+                foundOutput.addInput(self)
         if self.keys[1] in self.source:
             if 'collection' in self.source[self.keys[1]]:
                 for recType in list(self.source[self.keys[1]]['collection']):
-                    foundInput = MongoCollection(recType, {})
-                    self.inputs.append(foundInput)
-                    self.inputs[-1].outputs.append(self)
+                    foundInput = self.addInput(MongoCollection(recType, {}))
+                    foundInput.addOutput(self)
             if 'dedicated_partitions' in self.source[self.keys[1]]:
                     self.partitions = self.source[self.keys[1]]['dedicated_partitions']
 
 # A TreeElement specified for the example Stream server config documents
 class StreamElement(TreeElement):
+    __slots__ = ('buildNum', 'groups', 'inputGroups')
     keys = ['apiEndpoint','packed','unpacked','agents_unpacked','updates']
     colorMap = dict(zip(keys, ['black', 'khaki', 'yellow', 'cadetblue', 'darkcyan']))
 
@@ -232,6 +1334,7 @@ class StreamElement(TreeElement):
         super().__init__(name, source)
         self.buildNum = buildNum
         self.groups = []
+        self.inputGroups = {} # input id (nickname) -> the first group it was read in, i.e. the group of the edge from it
         self.populateIO()
 
     def __str__(self):
@@ -239,41 +1342,74 @@ class StreamElement(TreeElement):
         lines[2:2] = ['Build #: ' + str(self.buildNum), 'Groups: [' + ', '.join(self.groups) + ']']
         return '\n'.join(lines)
 
+    def serialize(self):
+        data = super().serialize()
+        data.update({'buildNum' : self.buildNum, 'groups' : self.groups, 'inputGroups' : self.inputGroups})
+        return data
+
+    def merge(self, other):
+        super().merge(other)
+        for nickname, group in getattr(other, 'inputGroups', {}).items():
+            self.inputGroups.setdefault(nickname, group)
+        return self
+
+    def unlink(self, element):
+        super().unlink(element)
+        self.inputGroups.pop(element.nickname, None)
+
     def populateIO(self):
         for key in self.keys:
             if key in self.source:
                 if key == 'apiEndpoint':
-                    foundOutput = TreeElement(self.source[key],{})
-                    self.outputs.append(foundOutput)
-                    self.outputs[-1].inputs.append(self)
+                    foundOutput = self.addOutput(TreeElement(self.source[key],{}))
+                    foundOutput.addInput(self)
                 else:
                     self.groups.append(key)
-                    foundInput = KafkaTopic(self.source[key]['topic'], {})
-                    self.inputs.append(foundInput)
-                    self.inputs[-1].streamInput(self, key)
+                    foundInput = self.addInput(KafkaTopic(self.source[key]['topic'], {}))
+                    foundInput.streamInput(self, key)
+                    self.inputGroups.setdefault(foundInput.nickname, key)
 
     def colorHandler(self, other):
-        for i in range(len(self.inputs)):
-            if self.inputs[i] == other:
-                return self.colorMap[self.groups[i]]
-        return 'black'
+        group = self.inputGroups.get(other.nickname)
+        return self.colorMap[group] if group in self.colorMap else 'black'
 
 # A TreeElement which removes a commmon prefix from MongoDB collections referenced in the example server config documents
 class MongoCollection(TreeElement):
+    __slots__ = ()
+
     def __init__(self, name, source):
         super().__init__(name, source)
-        self.nickname = re.sub(r'prefix\.|[\"]', '', name)
+        self.nickname = sys.intern(re.sub(r'prefix\.|[\"]', '', name))
 
 # A TreeElement which removes a common prefix from Kafka topics referenced in the example server config documents
 class KafkaTopic(TreeElement):
+    __slots__ = ('outputGroups',)
+
     def __init__(self, name, source):
         super().__init__(name, source)
-        self.nickname = re.sub(r'alt-prefix-', '', name)
+        self.nickname = sys.intern(re.sub(r'alt-prefix-', '', name))
         self.outputGroups = {}
 
+    def serialize(self):
+        data = super().serialize()
+        data.update({'outputGroups' : self.outputGroups})
+        return data
+
+    def merge(self, other):
+        super().merge(other)
+        for nickname, group in getattr(other, 'outputGroups', {}).items():
+            self.outputGroups.setdefault(nickname, group)
+        return self
+
+    def unlink(self, element):
+        super().unlink(element)
+        self.outputGroups.pop(element.nickname, None)
+
     def streamInput(self, other, key):
-        self.outputs.append(other)
-        self.outputGroups.update({other.nickname : key})
+        self.addOutput(other)
+        self.outputGroups.setdefault(other.nickname, key) # the first group it's read in, matching the stream's inputGroups
+
+nodeTypes.update({cls.__name__ : cls for cls in (TreeElement, ApiElement, StreamElement, MongoCollection, KafkaTopic)})
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,9 @@
+# Importable alias for server-map.py, whose hyphenated filename can't be imported directly, e.g. "from server_map import ServerMap"
+import importlib.util
+import os
+import sys
+
+spec = importlib.util.spec_from_file_location(__name__, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server-map.py'))
+module = importlib.util.module_from_spec(spec)
+sys.modules[__name__] = module # replaces this alias so pickled references (e.g. from the parse pool) resolve to the real module
+spec.loader.exec_module(module)